@@ -1,4 +1,4 @@
 from .agents import USER_AGENTS
-from .browser import Browser, FetchOutcome, HEADERS
+from .browser import Browser, FetchOutcome, FetchResult, HEADERS, create_session
 from .persist import back_by_storage
 from .rate_limiter import limit_actions
@@ -1,12 +1,14 @@
 from enum import Enum
 from ssl import SSLError
+from typing import NamedTuple, Any, Optional
 import asyncio
 import logging
 
 import aiohttp
-import ujson
+import orjson
+from yarl import URL
 
-from rc_crawler.utils import describe_exception
+from rc_crawler.utils import describe_exception, json_dumps
 from .agents import renew_agent
 
 logger = logging.getLogger("rc_crawler.browser")
@@ -17,17 +19,84 @@ RETRY_STATUS_CODES = {408, 500, 502, 503, 504}
 # the urls we follow should not have produced these codes, when not using proxy
 PROXY_ERROR_STATUS_CODES = {403, 404, 407, 515}
 
+REDIRECT_STATUS_CODES = {301, 302, 303, 307, 308}
+
+# redirects are followed by the browser itself, to give each hop its own cookies
+MAX_REDIRECTS = 10
+
+# responses with larger bodies are given up, their connections dropped
+MAX_BODY_SIZE = 10 * 1024 * 1024
+
+# aiohttp decodes brotli responses only when one of these libraries is installed
+try:
+    import brotlicffi as brotli
+except ImportError:
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
 HEADERS = {
     'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-    'Accept-Encoding': 'gzip, deflate',
+    'Accept-Encoding': 'br, gzip, deflate' if brotli else 'gzip, deflate',
     'Accept-Language': 'en-US,en;q=0.5',
     'Connection': 'keep-alive',
 }
 
+# response headers that let the server answer 304 Not Modified next time, mapped to the request header carrying them
+VALIDATOR_HEADERS = {
+    'ETag': 'If-None-Match',
+    'Last-Modified': 'If-Modified-Since',
+}
+
+
+def create_session() -> aiohttp.ClientSession:
+    """ returns a client session to be shared by all browsers of a crawl, the caller closes it
+
+        one connection pool serves every browser, so keep-alive connections to a host are reused
+        across scrapers. cookies are not kept in the session, each browser holds its own cookie jar.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=500, limit_per_host=32, ttl_dns_cache=300, keepalive_timeout=85, enable_cleanup_closed=True)
+
+    return aiohttp.ClientSession(
+        connector=connector, cookie_jar=aiohttp.DummyCookieJar(), headers=HEADERS, json_serialize=json_dumps)
+
+
+async def read_body(response: aiohttp.ClientResponse, max_size: int) -> Optional[bytes]:
+    """ returns the body of <response>, or None once it turns out to be larger than <max_size> bytes """
+    if response.content_length is not None and response.content_length > max_size:
+        return None
+
+    chunks = []
+    size = 0
+
+    async for chunk in response.content.iter_any():
+        size += len(chunk)
+
+        if size > max_size:
+            return None
+
+        chunks.append(chunk)
+
+    return b"".join(chunks)
+
+
+def decode_text(body: bytes, charset: Optional[str]) -> str:
+    """ returns <body> decoded with <charset>, or with utf-8 when none is declared or it is unknown
+
+        an explicit encoding skips aiohttp's charset detection, undecodable bytes are replaced
+    """
+    try:
+        return body.decode(charset or "utf-8", errors="replace")
+    except LookupError:
+        return body.decode("utf-8", errors="replace")
+
 
 class FetchOutcome(Enum):
     SUCCESS = "success"
     FAILURE = "failure"
+    NOT_MODIFIED = "not_modified"
 
     # requires retry:
     RETRY = "retry"
@@ -36,15 +105,26 @@ class FetchOutcome(Enum):
     MAYBE_PROXY_FAILURE = "maybe_proxy_failure"
 
 
+class FetchResult(NamedTuple):
+    outcome: FetchOutcome
+    content: Any = None                 # on success
+    reason: Any = None                  # on failure
+    validators: Optional[dict] = None   # on success, {validator header: value} for conditional requests
+    from_cache: bool = False
+    switch_agent: bool = False          # on anti-scraping, whether the agent is burnt
+
+
 class Browser:
-    def __init__(self, device_type):
-        """ a browser context consists of a aiohttp client session, a header that mimics
-            <device_type> user agent and a proxy used to make any requests.
+    def __init__(self, device_type, session):
+        """ a browser context consists of the shared aiohttp client <session>, its own cookie jar,
+            a header that mimics <device_type> user agent and a proxy used to make any requests.
         """
         self.device_type = device_type
 
-        self.session = None
+        self.session = session
+        self.cookie_jar = None
         self.user_agent = None
+        self.headers = None
         self.proxy = None
 
     def __str__(self):
@@ -53,61 +133,119 @@ class Browser:
 
     def switch_agent(self):
         self.user_agent, self.proxy = renew_agent(self.device_type)
-        self.session.cookie_jar.clear()
+        self.headers = {"User-Agent": self.user_agent}
+
+        # cookies belong to the agent identity, a new identity starts with a fresh jar
+        self.cookie_jar = aiohttp.CookieJar()
+
+    async def _get(self, url, headers, params):
+        """ send a GET request to <url> with query <params>, following redirects one hop at a time
+
+            each hop is sent the cookies the browser's jar holds for its own url, and the cookies set
+            on the way are kept in the jar, so a redirect to another site gets none of the first one's
+            returns the final response, released by the caller
+        """
+        history = []
+
+        for i in range(MAX_REDIRECTS + 1):
+            response = await self.session.get(
+                url, headers=headers, proxy=self.proxy, params=params,
+                cookies=self.cookie_jar.filter_cookies(URL(url)), allow_redirects=False)
+
+            self.cookie_jar.update_cookies(response.cookies, response.url)
+
+            location = response.headers.get("Location") if response.status in REDIRECT_STATUS_CODES else None
+
+            try:
+                next_url = response.url.join(URL(location)) if location else None
+            except ValueError:
+                next_url = None
+
+            if next_url is None or next_url.scheme not in ("http", "https"):
+                return response
+
+            response.release()
+            history.append(response)
+
+            # the query is part of the redirect location
+            url, params = next_url, None
+
+        raise aiohttp.TooManyRedirects(history[0].request_info, tuple(history))
 
     async def fetch(self, url, params=None, extra_headers=None, filetype="text"):
         """ fetch content from <url> with query <params>
             filetype: text/json/binary
-            returns {"outcome": ..., (optional) "content": ..., (optional) "reason": "reason for failure"}
+            returns FetchResult with content (and validators) on success, or the reason for failure
         """
-        headers = {"User-Agent": self.user_agent}
-        headers.update(extra_headers or {})
+        # aiohttp copies the headers into the request, so the agent's headers are passed as they are
+        headers = {**self.headers, **extra_headers} if extra_headers else self.headers
 
-        logger.debug("sending request to {0}, params: {1}, extra headers: {2}, proxy: {3}".format(
-            url, params, extra_headers, self.proxy))
+        logger.debug("sending request to %s, params: %s, extra headers: %s, proxy: %s",
+                     url, params, extra_headers, self.proxy)
 
         try:
-            async with self.session.get(url, headers=headers, proxy=self.proxy, params=params) as response:
-                content = await getattr(response, "read" if filetype == "binary" else filetype)()
+            async with await self._get(url, headers, params) as response:
+                body = await read_body(response, MAX_BODY_SIZE)
+
+                if body is None:
+                    # not worth reading the rest, the connection is not reused
+                    response.close()
+                    return FetchResult(FetchOutcome.FAILURE, reason="body larger than {} bytes".format(MAX_BODY_SIZE))
+
+                if filetype == "text":
+                    content = decode_text(body, response.charset)
+                else:
+                    # json is parsed only from a 200 response, error pages are seldom json
+                    content = body
+
+                if response.status == 200 and filetype == "json":
+                    try:
+                        # orjson parses several times faster than the json module
+                        content = orjson.loads(body)
+                    except orjson.JSONDecodeError as e:
+                        return FetchResult(FetchOutcome.RETRY, reason=describe_exception(e))
 
                 if response.status == 200:
-                    result = {"outcome": FetchOutcome.SUCCESS, "content": content}
+                    validators = {k: response.headers[k] for k in VALIDATOR_HEADERS if k in response.headers}
+                    result = FetchResult(FetchOutcome.SUCCESS, content, validators=validators)
+                elif response.status == 304:
+                    result = FetchResult(FetchOutcome.NOT_MODIFIED)
                 else:
-                    logger.error("non-200 response, url: {0}, request headers: {1}, status: {2}, content: {3}".format(
-                        url, response.request_info.headers, response.status, content))
+                    logger.error("non-200 response, url: %s, request headers: %s, status: %s, content: %s",
+                                 url, response.request_info.headers, response.status, content)
 
                     if response.status in PROXY_ERROR_STATUS_CODES:
-                        result = {"outcome": FetchOutcome.PROXY_FAILURE, "reason": response.status}
+                        result = FetchResult(FetchOutcome.PROXY_FAILURE, reason=response.status)
                     elif response.status in RETRY_STATUS_CODES:
-                        result = {"outcome": FetchOutcome.RETRY, "reason": response.status}
+                        result = FetchResult(FetchOutcome.RETRY, reason=response.status)
                     else:
-                        result = {"outcome": FetchOutcome.FAILURE, "reason": response.status}
+                        result = FetchResult(FetchOutcome.FAILURE, reason=response.status)
 
         except aiohttp.ClientHttpProxyError as e:
             # subclass of ClientResponseError
-            result = {"outcome": FetchOutcome.PROXY_FAILURE, "reason": describe_exception(e)}
+            result = FetchResult(FetchOutcome.PROXY_FAILURE, reason=describe_exception(e))
 
         except (ConnectionResetError, SSLError, aiohttp.ClientPayloadError, aiohttp.ClientResponseError) as e:
-            result = {"outcome": FetchOutcome.RETRY, "reason": describe_exception(e)}
+            result = FetchResult(FetchOutcome.RETRY, reason=describe_exception(e))
 
         except aiohttp.ClientConnectorError as e:
             # subclass of ClientConnectionError
             if isinstance(e.__cause__, ConnectionResetError):
-                result = {"outcome": FetchOutcome.RETRY, "reason": describe_exception(e)}
+                result = FetchResult(FetchOutcome.RETRY, reason=describe_exception(e))
             else:
                 # includes ClientProxyConnectionError as cause
-                result = {"outcome": FetchOutcome.MAYBE_PROXY_FAILURE, "reason": describe_exception(e)}
+                result = FetchResult(FetchOutcome.MAYBE_PROXY_FAILURE, reason=describe_exception(e))
 
         except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
             # includes ServerDisconnectedError, ClientOSError
-            result = {"outcome": FetchOutcome.MAYBE_PROXY_FAILURE, "reason": describe_exception(e)}
+            result = FetchResult(FetchOutcome.MAYBE_PROXY_FAILURE, reason=describe_exception(e))
 
         return result
 
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession(headers=HEADERS, json_serialize=ujson.dumps)
         self.switch_agent()
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
-        await self.session.close()
+        # the session is shared with other browsers, its owner closes it
+        pass
@@ -1,24 +1,56 @@
 from base64 import urlsafe_b64encode
+from functools import lru_cache
 from pathlib import Path
-from typing import Tuple
-from urllib.parse import urlsplit, parse_qs, urlencode, SplitResult
+from typing import Dict, Tuple, Set, Optional
+from urllib.parse import urlsplit, unquote_plus, SplitResult
+import asyncio
 import logging
+import os
 
-import aiofiles
+import zstandard
 
-from .browser import FetchOutcome
+from .browser import FetchOutcome, FetchResult, VALIDATOR_HEADERS
 
 logger = logging.getLogger("rc_crawler.persist")
 
 STORAGE_PATH = "pages"
 QUERY_PARAM_VALUE_MAX_LENGTH = 30
+PAGE_FILE_SUFFIX = ".zst"
+VALIDATORS_FILE_SUFFIX = ".hdr"
+ZSTD_LEVEL = 3
+FILEPATH_CACHE_SIZE = 65536
+
+# directories already created in this process, saves a mkdir syscall per page written.
+# filled from executor threads, two writers racing only cost a redundant mkdir(exist_ok=True)
+_created_dirs: Set[Path] = set()
+
+# filenames saved in each directory, listed once so that cache lookups need no stat syscall
+_dir_index: Dict[Path, Set[str]] = {}
+
+# listings of directories under way, awaited by every scraper looking the directory up meanwhile
+_dir_listings: Dict[Path, asyncio.Future] = {}
+
+# directory of the latest earlier run of the same platform, for each run directory
+_previous_run_dirs: Dict[Path, Optional[Path]] = {}
 
 
 def build_concise_url(url_parts: SplitResult) -> str:
-    """ shorten the url while keeping important details """
-    query_params = parse_qs(url_parts.query)
-    trimmed_query_params = {n: l for n, l in query_params.items() if sum(len(v) for v in l) < QUERY_PARAM_VALUE_MAX_LENGTH}
-    new_qs = urlencode(trimmed_query_params, doseq=True)
+    """ shorten the url while keeping important details
+
+        drops the query params whose decoded values add up to QUERY_PARAM_VALUE_MAX_LENGTH characters
+        or more, and those without a value, in a single pass over the query string.
+    """
+    value_lengths = {}
+    params = []
+
+    for param in url_parts.query.split('&'):
+        name, _, value = param.partition('=')
+
+        if value:
+            value_lengths[name] = value_lengths.get(name, 0) + len(unquote_plus(value))
+            params.append((name, param))
+
+    new_qs = '&'.join(p for n, p in params if value_lengths[n] < QUERY_PARAM_VALUE_MAX_LENGTH)
 
     if new_qs:
         return "{0}?{1}".format(url_parts.path, new_qs)
@@ -32,8 +64,14 @@ def get_filepath(url: str, run_timestamp: int) -> Tuple[Path, str]:
         url: url where the html is fetched from
         run_timestamp: UNIX timestamp when the crawl started
 
-        returns <STORAGE_PATH>/<platform>/<run timestamp>, <base64 encoded url>.html
+        returns <STORAGE_PATH>/<platform>/<run timestamp>, <base64 encoded url>.zst
     """
+    return _get_filepath(url, run_timestamp, STORAGE_PATH)
+
+
+@lru_cache(maxsize=FILEPATH_CACHE_SIZE)
+def _get_filepath(url: str, run_timestamp: int, storage_path: str) -> Tuple[Path, str]:
+    """ memoized get_filepath, urls are fetched again on retries and re-crawls """
     url_parts = urlsplit(url)
     netloc_terms = url_parts.netloc.split('.')
 
@@ -42,14 +80,100 @@ def get_filepath(url: str, run_timestamp: int) -> Tuple[Path, str]:
 
     concise_url = build_concise_url(url_parts)
 
-    dirpath = Path(STORAGE_PATH) / platform / str(run_timestamp)
-    filename = urlsafe_b64encode(concise_url.encode()).decode()
+    dirpath = Path(storage_path) / platform / str(run_timestamp)
+    filename = urlsafe_b64encode(concise_url.encode()).decode() + PAGE_FILE_SUFFIX
 
     assert len(filename) < 256, "length of filename generated has exceeded Linux filesystem limit"
 
     return dirpath, filename
 
 
+def _list_dir(dirpath: Path) -> Set[str]:
+    """ returns names of the files in <dirpath>, empty if it does not exist (blocking) """
+    try:
+        with os.scandir(dirpath) as entries:
+            return {e.name for e in entries}
+    except FileNotFoundError:
+        return set()
+
+
+def _find_previous_run_dir(dirpath: Path) -> Optional[Path]:
+    """ returns the directory of the latest run before the run saved in <dirpath>, None if there is none (blocking) """
+    run_timestamp = int(dirpath.name)
+    earlier = [int(name) for name in _list_dir(dirpath.parent) if name.isdigit() and int(name) < run_timestamp]
+
+    return dirpath.parent / str(max(earlier)) if earlier else None
+
+
+def _read_validators(path: Path) -> Dict[str, str]:
+    """ read the validator headers saved at <path>, one "name: value" per line (blocking) """
+    with open(path) as f:
+        return dict(line.rstrip("\n").split(": ", 1) for line in f)
+
+
+def _write_validators(path: Path, validators: Dict[str, str]) -> None:
+    """ save the validator headers to <path>, one "name: value" per line (blocking) """
+    with open(path, "w") as f:
+        f.writelines("{0}: {1}\n".format(name, value) for name, value in validators.items())
+
+
+def _read_page(path: Path) -> str:
+    """ read and decompress the page saved at <path> (blocking, run it in an executor) """
+    with open(path, "rb") as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        data = f.read()
+
+    return zstandard.ZstdDecompressor().decompress(data).decode()
+
+
+def _write_page(dirpath: Path, path: Path, html: str) -> None:
+    """ compress and save <html> to <path> (blocking, run it in an executor)
+
+        html shrinks about tenfold with zstd, which costs less cpu than writing the raw page.
+        pages are written once and seldom read back in the same run,
+        so the kernel is advised not to keep them in page cache.
+    """
+    data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(html.encode())
+
+    if dirpath not in _created_dirs:
+        dirpath.mkdir(parents=True, exist_ok=True)
+        _created_dirs.add(dirpath)
+
+    with open(path, "wb") as f:
+        f.write(data)
+
+        if hasattr(os, "posix_fadvise"):
+            f.flush()
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def _save_page(dirpath: Path, filename: str, html: str, validators_filename: str, validators: Optional[Dict[str, str]]):
+    """ save <html> and its <validators>, if any, with a single executor hop per page (blocking) """
+    _write_page(dirpath, dirpath / filename, html)
+
+    if validators:
+        _write_validators(dirpath / validators_filename, validators)
+
+
+async def _get_dir_index(dirpath: Path) -> Set[str]:
+    """ returns names of the files in <dirpath>, listed on first use and kept up to date by the middleware
+
+        scrapers asking while the listing is under way wait for the same listing, so that a page saved meanwhile
+        is not lost from the index by a second listing replacing the first
+    """
+    if dirpath not in _dir_index:
+        if dirpath not in _dir_listings:
+            _dir_listings[dirpath] = asyncio.get_running_loop().run_in_executor(None, _list_dir, dirpath)
+
+        names = await _dir_listings[dirpath]
+        _dir_index.setdefault(dirpath, names)
+        _dir_listings.pop(dirpath, None)
+
+    return _dir_index[dirpath]
+
+
 def back_by_storage(run_timestamp):
     """ middleware to cache page to filesystem storage
 
@@ -58,30 +182,62 @@ def back_by_storage(run_timestamp):
         (decoratee)
         next_handler: coroutine that fetches html from a url
 
-        returns a new coroutine that uses filesystem as cache when doing the fetching
+        returns a new coroutine that uses filesystem as cache when doing the fetching.
+        a page saved by the previous run is revalidated with a conditional request,
+        and reused if the server answers 304 Not Modified.
     """
     def middleware_factory(next_handler):
         async def middleware(url, *args, read_from_cache=True, **kwargs):
             dirpath, filename = get_filepath(url, run_timestamp)
             page_filepath = dirpath / filename
+            validators_filename = filename[:-len(PAGE_FILE_SUFFIX)] + VALIDATORS_FILE_SUFFIX
+            previous_page_filepath = None
+            loop = asyncio.get_running_loop()
+
+            if read_from_cache:
+                if filename in await _get_dir_index(dirpath):
+                    logger.info("reading from %s instead of fetching from %s", page_filepath, url)
+
+                    html = await loop.run_in_executor(None, _read_page, page_filepath)
+                    return FetchResult(FetchOutcome.SUCCESS, html, from_cache=True)
 
-            if page_filepath.exists() and read_from_cache:
-                logger.info("reading from {0} instead of fetching from {1}".format(page_filepath, url))
+                if dirpath not in _previous_run_dirs:
+                    _previous_run_dirs[dirpath] = await loop.run_in_executor(None, _find_previous_run_dir, dirpath)
 
-                async with aiofiles.open(page_filepath) as f:
-                    html = await f.read()
-                    return {"outcome": FetchOutcome.SUCCESS, "content": html, "from_cache": True}
+                previous_dirpath = _previous_run_dirs[dirpath]
+
+                if previous_dirpath and validators_filename in await _get_dir_index(previous_dirpath):
+                    previous_page_filepath = previous_dirpath / filename
+                    validators = await loop.run_in_executor(
+                        None, _read_validators, previous_dirpath / validators_filename)
+
+                    kwargs["extra_headers"] = {
+                        **(kwargs.get("extra_headers") or {}),
+                        **{VALIDATOR_HEADERS[name]: value for name, value in validators.items()},
+                    }
 
             result = await next_handler(url, *args, **kwargs)
-            result["from_cache"] = False
 
-            if result["outcome"] == FetchOutcome.SUCCESS:
-                logger.debug("save html from {1} to {0}".format(page_filepath, url))
+            if result.outcome == FetchOutcome.NOT_MODIFIED and previous_page_filepath is None:
+                # no conditional request was sent, a proxy or cache on the way answered with a 304 anyway
+                logger.warning("unrequested 304 Not Modified from %s", url)
+
+                result = FetchResult(FetchOutcome.RETRY, reason="304 Not Modified without a conditional request")
+
+            elif result.outcome == FetchOutcome.NOT_MODIFIED:
+                logger.info("%s not modified, reading from %s", url, previous_page_filepath)
+
+                html = await loop.run_in_executor(None, _read_page, previous_page_filepath)
+                result = FetchResult(FetchOutcome.SUCCESS, html, validators=validators, from_cache=True)
+
+            if result.outcome == FetchOutcome.SUCCESS:
+                logger.debug("save html from %s to %s", url, page_filepath)
 
-                dirpath.mkdir(parents=True, exist_ok=True)
+                await loop.run_in_executor(
+                    None, _save_page, dirpath, filename, result.content, validators_filename, result.validators)
 
-                async with aiofiles.open(page_filepath, 'w') as f:
-                    await f.write(result["content"])
+                if dirpath in _dir_index:
+                    _dir_index[dirpath].update((filename, validators_filename) if result.validators else (filename,))
 
             return result
 
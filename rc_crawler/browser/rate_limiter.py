@@ -1,53 +1,65 @@
+from collections import defaultdict
+from urllib.parse import urlsplit
 import asyncio
 import random
 import time
 
 
-# see https://stackoverflow.com/questions/45440900/throttling-async-functions-in-python-asyncio
+class AsyncTokenBucket(object):
+    """A token bucket rate limiter.
 
-class AsyncLeakyBucket(object):
-    """A leaky bucket rate limiter.
-
-    Allows up to max_rate / time_period acquisitions before blocking.
+    Holds up to max_rate tokens, refilled at max_rate / time_period tokens per second,
+    so bursts of max_rate acquisitions are allowed before blocking.
 
     time_period is measured in seconds; the default is 60.
 
+    A <reserve> fraction of the capacity is only available to priority acquisitions,
+    so that they are not queued behind ordinary ones.
+
+    Waiters are served in arrival order, separately for priority and ordinary acquisitions,
+    and only the one at the head of each line sleeps waiting for tokens.
+
     """
-    def __init__(self, max_rate: float, time_period: float = 60) -> None:
-        self._max_level = max_rate
+    def __init__(self, max_rate: float, time_period: float = 60, reserve: float = 0.25) -> None:
+        self._capacity = max_rate
         self._rate_per_sec = max_rate / time_period
-        self._level = 0.0
-        self._last_check = 0.0
+        self._reserve = reserve * max_rate
+        self._tokens = float(max_rate)
+        self._last_check = time.monotonic()
+        self._lines = {False: asyncio.Lock(), True: asyncio.Lock()}
+
+    def _refill(self) -> None:
+        """Add the tokens accrued since we last checked."""
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._last_check) * self._rate_per_sec, self._capacity)
+        self._last_check = now
 
-    def _leak(self) -> None:
-        """Drip out capacity from the bucket."""
-        if self._level:
-            # drip out enough level for the elapsed time since
-            # we last checked
-            elapsed = time.time() - self._last_check
-            decrement = elapsed * self._rate_per_sec
-            self._level = max(self._level - decrement, 0)
-        self._last_check = time.time()
+    def _watermark(self, amount: float, priority: bool) -> float:
+        """Tokens that must be left in the bucket after acquiring <amount>."""
+        return 0 if priority else min(self._reserve, self._capacity - amount)
 
-    def has_capacity(self, amount: float = 1) -> bool:
-        """Check if there is enough space remaining in the bucket"""
-        self._leak()
-        return self._level + amount <= self._max_level
+    def has_capacity(self, amount: float = 1, priority: bool = False) -> bool:
+        """Check if there are enough tokens in the bucket"""
+        self._refill()
+        return self._tokens - amount >= self._watermark(amount, priority)
 
-    async def acquire(self, amount: float = 1) -> None:
-        """Acquire space in the bucket.
+    async def acquire(self, amount: float = 1, priority: bool = False) -> None:
+        """Acquire tokens from the bucket.
 
-        If the bucket is full, block until there is space.
+        If there are not enough tokens, block until they are refilled.
 
         """
-        if amount > self._max_level:
+        if amount > self._capacity:
             raise ValueError("Can't acquire more than the bucket capacity")
 
-        while not self.has_capacity(amount):
-            # wait for the next drip to have left the bucket
-            await asyncio.sleep(1 / self._rate_per_sec)
+        # asyncio.Lock wakes its waiters one at a time in FIFO order
+        async with self._lines[priority]:
+            while not self.has_capacity(amount, priority):
+                # wait for the missing tokens to be refilled
+                deficit = amount + self._watermark(amount, priority) - self._tokens
+                await asyncio.sleep(deficit / self._rate_per_sec)
 
-        self._level += amount
+            self._tokens -= amount
 
     async def __aenter__(self) -> None:
         await self.acquire()
@@ -58,24 +70,25 @@ class AsyncLeakyBucket(object):
 
 
 def limit_actions(rate_limit_params):
-    """ middleware to limit actions
+    """ middleware to limit actions, separately for each host
 
         (platform-dependent arguments)
         rate_limit_params: [{max_rate: ..., time_period: ...}, ...]
 
         (decoratee)
-        next_handler: coroutine that performs an action and returns a result
+        next_handler: coroutine that performs an action on a url and returns a result
 
-        returns a new coroutine that executes <next_handler> subject to <rate_limit_params>
+        returns a new coroutine that executes <next_handler> subject to <rate_limit_params>,
+        with keyword argument priority=True the reserved capacity may be used (for retries)
     """
-    leaky_buckets = [AsyncLeakyBucket(**kwargs) for kwargs in rate_limit_params]
+    host_buckets = defaultdict(lambda: [AsyncTokenBucket(**kwargs) for kwargs in rate_limit_params])
 
     def middleware_factory(next_handler):
-        async def middleware(*args, **kwargs):
-            for bucket in leaky_buckets:
-                await bucket.acquire(amount=random.random() + 1)  # rate limiting to avoid detection
+        async def middleware(url, *args, priority=False, **kwargs):
+            for bucket in host_buckets[urlsplit(url).netloc]:
+                await bucket.acquire(amount=random.random() + 1, priority=priority)  # rate limiting to avoid detection
 
-            return await next_handler(*args, **kwargs)
+            return await next_handler(url, *args, **kwargs)
 
         return middleware
     return middleware_factory
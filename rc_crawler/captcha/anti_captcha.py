@@ -3,7 +3,7 @@ import asyncio
 import logging
 
 import aiohttp
-import ujson
+import orjson
 
 logger = logging.getLogger("rc_crawler.anti_captcha")
 
@@ -12,6 +12,7 @@ CLIENT_KEY = None
 API_BASE_URL = "https://api.anti-captcha.com/"
 CREATE_TASK_SEND_INTERVAL = 10
 GET_TASK_RESULT_POLL_INTERVAL = 2.5
+JSON_HEADERS = {"Content-Type": "application/json"}
 
 
 class AntiCaptchaException(Exception):
@@ -34,15 +35,16 @@ class CaptchaSolver:
     def __init__(self):
         self.session = None
 
-    async def _request(self, endpoint: str, data: dict) -> dict:
+    async def _request(self, endpoint: str, payload: bytes) -> dict:
+        """ post the json encoded <payload> to <endpoint> """
         url = API_BASE_URL + endpoint
 
         try:
-            async with self.session.post(url, json=data) as response:
-                result = await response.json()
+            async with self.session.post(url, data=payload, headers=JSON_HEADERS) as response:
+                result = await response.json(loads=orjson.loads)
 
                 if result["errorId"]:
-                    logger.error("api error happens when requesting {0} with {1}".format(url, data))
+                    logger.error("api error happens when requesting %s with %s", url, payload[:200])
                     raise AntiCaptchaAPIError(result["errorId"], result["errorCode"], result["errorDescription"])
 
                 return result
@@ -50,15 +52,18 @@ class CaptchaSolver:
         except aiohttp.ClientResponseError as e:
             raise AntiCaptchaServiceError("anti-captcha server returns HTTP 4xx or HTTP 5xx") from e
 
-    async def create_task(self, body: str) -> int:
-        data = {
-            "clientKey": CLIENT_KEY,
-            "task": {"type":"ImageToTextTask", "body": body, "case": True},
-        }
+    async def create_task(self, body: bytes) -> int:
+        """ body: base64 encoded image """
+        # the envelope is assembled around the image bytes, instead of serializing a dict holding
+        # a decoded copy of the image, base64 characters need no escaping in json
+        payload = b''.join([
+            b'{"clientKey":', orjson.dumps(CLIENT_KEY),
+            b',"task":{"type":"ImageToTextTask","case":true,"body":"', body, b'"}}',
+        ])
 
         while True:
             try:
-                result = await self._request("createTask", data)
+                result = await self._request("createTask", payload)
             except AntiCaptchaAPIError as e:
                 if e.error_code == "ERROR_NO_SLOT_AVAILABLE":
                     logger.exception(e)
@@ -70,13 +75,13 @@ class CaptchaSolver:
             await asyncio.sleep(CREATE_TASK_SEND_INTERVAL)
 
     async def get_task_result(self, task_id: int) -> str:
-        data = {
+        payload = orjson.dumps({
             "clientKey": CLIENT_KEY,
             "taskId": task_id
-        }
+        })
 
         while True:
-            result = await self._request("getTaskResult", data)
+            result = await self._request("getTaskResult", payload)
 
             if result["status"] == "ready":
                 return result["solution"]["text"]
@@ -84,15 +89,15 @@ class CaptchaSolver:
             await asyncio.sleep(GET_TASK_RESULT_POLL_INTERVAL)
 
     async def solve_captcha(self, image_binary: bytes) -> str:
-        body = b64encode(image_binary).decode()
+        body = b64encode(image_binary)
 
         task_id = await self.create_task(body)
-        logger.debug("submitted task {} to anti-captcha.com".format(task_id))
+        logger.debug("submitted task %s to anti-captcha.com", task_id)
 
         return await self.get_task_result(task_id)
 
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession(json_serialize=ujson.dumps, raise_for_status=True)
+        self.session = aiohttp.ClientSession(raise_for_status=True)
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
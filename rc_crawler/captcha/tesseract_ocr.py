@@ -1,27 +1,62 @@
-import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import blake2b
 from io import BytesIO
-from PIL import Image
+import asyncio
+import os
 
+from PIL import Image
 import pytesseract
 
-from rc_crawler.utils import DummyAsyncContextManager
+# captchas come in these formats, other decoders are neither probed nor loaded
+IMAGE_FORMATS = ("JPEG", "PNG")
+
+# solutions of the latest captchas, by image digest. the same captcha is met again when its page is retried
+SOLUTION_CACHE_SIZE = 512
 
 
 def ocr(image_binary: bytes, config: dict) -> str:
-    """ return the characters contained in <image_binary> """
+    """ return the characters contained in <image_binary>, read in grayscale """
     with BytesIO(image_binary) as b:
         try:
-            with Image.open(b) as img:
-                return pytesseract.image_to_string(img, config=config)
+            with Image.open(b, formats=IMAGE_FORMATS) as img:
+                return pytesseract.image_to_string(img.convert("L"), config=config)
         except OSError:
             raise ValueError("invalid image binary string: {}".format(image_binary))
 
 
-class CaptchaSolver(DummyAsyncContextManager):
+class CaptchaSolver:
     def __init__(self, config: dict) -> None:
         self.config = config
+        self.executor = None
+        self.solutions = OrderedDict()
 
     async def solve_captcha(self, image_binary: bytes) -> str:
-        solution = ocr(image_binary, self.config)
+        # kept here rather than in ocr, which runs in the worker processes
+        digest = blake2b(image_binary, digest_size=16).digest()
+
+        if digest in self.solutions:
+            self.solutions.move_to_end(digest)
+            solution = self.solutions[digest]
+        else:
+            if self.executor is None:
+                raise RuntimeError("captcha solver used outside of its context, no process pool to run ocr")
+
+            # tesseract is cpu-bound, keep it off the event loop so that other scrapers carry on fetching
+            loop = asyncio.get_running_loop()
+            solution = await loop.run_in_executor(self.executor, ocr, image_binary, self.config)
+
+            self.solutions[digest] = solution
+
+            if len(self.solutions) > SOLUTION_CACHE_SIZE:
+                self.solutions.popitem(last=False)
+
         await asyncio.sleep(4)  # imitate human
         return solution
+
+    async def __aenter__(self):
+        self.executor = ProcessPoolExecutor(max_workers=os.cpu_count())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.executor.shutdown()
@@ -1,2 +1,2 @@
-from .crawler import Target, TargetPriority, Scraper, put_seed_urls
+from .crawler import Target, TargetPriority, Scraper, create_visited_filter, put_seed_urls
 from .exceptions import *
@@ -1,21 +1,58 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from enum import Enum
-from itertools import cycle
-from typing import NamedTuple, Callable, List, Tuple, Generator, TextIO, Union
+from functools import partial
+from heapq import heappush, heappop
+from itertools import count, islice
+from typing import Callable, List, Tuple, Generator, TextIO, Union
 import asyncio
 import logging
+import os
 
-from rc_crawler.browser import Browser, FetchOutcome
-from rc_crawler.utils import describe_exception
-from .captcha import solve_captcha
+from pybloom_live import ScalableBloomFilter
+
+from rc_crawler.browser import Browser, FetchOutcome, FetchResult
+from rc_crawler.utils import describe_exception, normalize_url
 from .exceptions import AntiScrapingError
 
 
+harvest_logger = logging.getLogger("rc_crawler.harvest")
+
+
 RETRY_MAX = 2
 PROXY_FAILURE_COUNT_MAX = 2
 PROXY_SUCCESS_REWARD = 0.25
 
-# message class for scraper coroutines
-class Target(NamedTuple):
+# outcomes of a download which are not retried
+FINAL_OUTCOMES = frozenset({FetchOutcome.SUCCESS, FetchOutcome.FAILURE})
+
+# seed targets waiting in a scraper, beyond which put_seed_urls waits for the scraper to catch up
+SEED_QUEUE_MAX = 1000
+
+# seed targets generated at a time and shared out among the scrapers
+SEED_BATCH_SIZE = 1000
+
+# listing urls already followed by a scraper are remembered in a bloom filter, which grows as needed
+VISITED_INITIAL_CAPACITY = 100000
+VISITED_ERROR_RATE = 1e-5
+
+# scraper ids, for logging use only
+_scraper_ids = count()
+
+# html parsing and selecting is cpu work, done in threads so that the event loop keeps serving other scrapers
+EXTRACTOR_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# extractor outputs of the latest pages, by the target fields they depend on, shared by all scrapers.
+# a page read from storage has the content last fetched for the same target, either saved earlier in this run
+# or revalidated with a 304 against the previous run's copy, so the output cached for that target is reused
+EXTRACTED_CACHE_SIZE = 10000
+_extracted = OrderedDict()
+
+# message class for scraper coroutines, slotted to keep the many queued targets small.
+# a target is only touched by the scraper that dequeued it, which bumps retry_count in place to retry it
+@dataclass(slots=True)
+class Target:
     keyword: str
     url: str
     referer: str
@@ -28,7 +65,6 @@ class Target(NamedTuple):
 class TargetPriority(Enum):
     DEFAULT = 0
     RETRY = 1
-    STOPPER = 20
 
 
 class PageCategory(Enum):
@@ -36,24 +72,29 @@ class PageCategory(Enum):
     LISTING = "listing"
 
 
-async def harvest(output, target, input_queue, run_timestamp):
+async def harvest(output, target, send_many, visited, run_timestamp):
     """ harvest extracted output from html, follow links and save data
+        send_many: function taking a list of (priority, target) to enqueue followed links
+        visited: bloom filter of listing urls followed before, which are skipped
         (function modifies output)
     """
-    logger = logging.getLogger("rc_crawler.harvest")
+    logger = harvest_logger
 
-    for key, value in output.items():
-        if not value:
-            logger.error("could not extract {0} from target: {1}".format(key, target))
+    missing = [key for key, value in output.items() if not value]
 
-    # follow links
+    if missing:
+        logger.error("could not extract %s from target: %s", missing, target)
+
+    # follow links, enqueued together in one batch
+    batch = []
+    priority = TargetPriority.DEFAULT.value
     next_url = output.pop("next_url", None)
 
     if next_url:
-        logger.debug("target: {0}, next_url: {1}".format(target, next_url))
+        logger.debug("target: %s, next_url: %s", target, next_url)
 
-        await input_queue.put((TargetPriority.DEFAULT.value, Target(
-            url=next_url,
+        batch.append((priority, Target(
+            url=normalize_url(next_url),
             referer=target.url,
             category=PageCategory.SEARCH.value,
             follow_next_count=target.follow_next_count + 1,
@@ -61,20 +102,37 @@ async def harvest(output, target, input_queue, run_timestamp):
         )))
 
     listing_urls = output.pop("listing_urls", [])
+    listing = PageCategory.LISTING.value
+
+    # normalized urls in the order found, duplicates dropped
+    for l_url in dict.fromkeys(normalize_url(u) for u in listing_urls):
+        # add returns True if the url is (probably) in the filter already
+        if visited.add(l_url):
+            continue
 
-    for l_url in listing_urls:
-        await input_queue.put((TargetPriority.DEFAULT.value, Target(
+        batch.append((priority, Target(
             url=l_url,
             referer=target.url,
-            category=PageCategory.LISTING.value,
+            category=listing,
             keyword=target.keyword
         )))
 
+    if batch:
+        send_many(batch)
+
     # save data
     output["timestamp"] = run_timestamp
     output["keyword"] = target.keyword
     output["url"] = target.url
-    logger.debug("output persisted: {}".format(output))
+    logger.debug("output persisted: %s", output)
+
+
+def create_visited_filter() -> ScalableBloomFilter:
+    """ returns a filter of the listing urls followed, to be shared by all scrapers of a crawl
+
+        the scrapers run on one event loop, so the filter needs no locking.
+    """
+    return ScalableBloomFilter(initial_capacity=VISITED_INITIAL_CAPACITY, error_rate=VISITED_ERROR_RATE)
 
 
 class Scraper:
@@ -85,20 +143,37 @@ class Scraper:
         (platform-dependent arguments)
         device_type: pose as desktop/tablet/mobile browser?
         extractors: {page_category: function extract_<page_category>: html, target, run_timestamp -> {key: value}}
+        session: aiohttp client session shared by all scrapers
         middlewares: a list of decorators for Browser object's fetch method,
         captcha_solver: a CaptchaSolver instance
+        visited: filter of listing urls followed by any scraper, the scraper keeps its own if not given
     """
-    def __init__(self, run_timestamp, device_type, extractors, middlewares=[], captcha_solver=None):
-        actor_id = str(hex(id(self)))[-6:]   # for logging use only, may not be unique
+    def __init__(self, run_timestamp, device_type, extractors, session, middlewares=[], captcha_solver=None,
+                 visited=None):
+        actor_id = next(_scraper_ids)
         self.logger = logging.getLogger("rc_crawler.scrape.{}".format(actor_id))
 
-        self.input_queue = asyncio.PriorityQueue()  # actor inbox
+        # actor inbox: heap of links followed and retries. the scraper itself is the only producer,
+        # and it only reads the inbox when there is something in it, so a plain heap does without queue locking
+        self.inbox = []
+
+        # seed targets, taken only when the inbox is empty. bounded, so that seeding is held back
+        # while the scraper is busy following links
+        self.seed_queue = asyncio.Queue(maxsize=SEED_QUEUE_MAX)
+
+        # tiebreaker placed after priority, so that the heap never falls back to comparing targets
+        self.sequence = count()
 
         self.run_timestamp = run_timestamp
         self.extractors = extractors
         self.captcha_solver = captcha_solver
 
-        self.browser = Browser(device_type)
+        self.visited = visited if visited is not None else create_visited_filter()
+
+        # headers of the target being downloaded, the dict is reused since targets are downloaded one at a time
+        self.extra_headers = {"Referer": None}
+
+        self.browser = Browser(device_type, session)
         self.download = self.browser.fetch
         self.middlewares = middlewares
 
@@ -106,8 +181,26 @@ class Scraper:
         for f in self.middlewares:
             self.download = f(self.download)
 
-    async def send(self, *args, **kwargs):
-        await self.input_queue.put(*args, **kwargs)
+    def send(self, priority, target):
+        """ put <target> in the inbox """
+        heappush(self.inbox, (priority, next(self.sequence), target))
+
+    def send_many(self, batch):
+        """ put every (priority, target) of <batch> in the inbox """
+        for priority, target in batch:
+            heappush(self.inbox, (priority, next(self.sequence), target))
+
+    async def send_seed(self, target):
+        """ put seed <target> in the seed queue, waiting while it is full, a target of None stops the scraper """
+        await self.seed_queue.put(target)
+
+    async def send_seeds(self, targets):
+        """ put seed <targets> in the seed queue, suspending only when it is full """
+        for target in targets:
+            if self.seed_queue.full():
+                await self.seed_queue.put(target)
+            else:
+                self.seed_queue.put_nowait(target)
 
     async def answer_captcha_challenge(self, challenge, referer):
         extra_headers = {"Referer": referer}
@@ -115,9 +208,9 @@ class Scraper:
 
         image_result = await self.browser.fetch(captcha_image_url, extra_headers=extra_headers, filetype="binary")
 
-        if image_result["outcome"] == FetchOutcome.SUCCESS:
+        if image_result.outcome == FetchOutcome.SUCCESS:
             try:
-                answer = await self.captcha_solver.solve_captcha(image_result["content"])
+                answer = await self.captcha_solver.solve_captcha(image_result.content)
             except Exception as e:
                 self.logger.exception(e)
                 challenge_result = {"outcome": "failure", "reason": "failed to solve captcha due to {}".format(e)}
@@ -129,18 +222,18 @@ class Scraper:
                         # the input field which has value None is the answer field
                         query_params = {k: v or answer for k, v in submission_form["data"].items()}
 
-                        self.logger.info("submission to captcha challenge {0} is {1}".format(captcha_image_url, query_params))
+                        self.logger.info("submission to captcha challenge %s is %s", captcha_image_url, query_params)
 
                         submission_result = await self.browser.fetch(
                             url=submission_form["action"], params=query_params, extra_headers=extra_headers
                         )
 
-                        if submission_result["outcome"] == FetchOutcome.SUCCESS:
+                        if submission_result.outcome == FetchOutcome.SUCCESS:
                             challenge_result = {"outcome": "success"}
                         else:
                             challenge_result = {
                                 "outcome": "failure",
-                                "reason": "solution submission failed due to {}".format(submission_result["reason"])
+                                "reason": "solution submission failed due to {}".format(submission_result.reason)
                             }
                     else:
                         challenge_result = {"outcome": "failure", "reason": "non-GET request is not yet supported"}
@@ -149,116 +242,128 @@ class Scraper:
         else:
             challenge_result = {
                 "outcome": "failure",
-                "reason": "failed to fetch captcha image due to {}".format(image_result["reason"]),
+                "reason": "failed to fetch captcha image due to {}".format(image_result.reason),
             }
 
         return challenge_result
 
+    async def extract(self, target, html, from_cache):
+        """ returns the output of the extractor for <target> on <html>, reused if the page is <from_cache> """
+        # the output depends on the request made and on how many result pages have been followed
+        key = (target.category, target.url, repr(target.params), target.follow_next_count)
+
+        if from_cache and key in _extracted:
+            _extracted.move_to_end(key)
+        else:
+            extract = partial(self.extractors[target.category], html, target=target, run_timestamp=self.run_timestamp)
+            _extracted[key] = await asyncio.get_running_loop().run_in_executor(EXTRACTOR_POOL, extract)
+
+            if len(_extracted) > EXTRACTED_CACHE_SIZE:
+                _extracted.popitem(last=False)
+
+        # harvest modifies the output, the cached one is kept intact
+        return dict(_extracted[key])
+
     async def handle_download_success(self, target, html, from_cache):
         """ extract and harvest <html>, answer any captcha challenge presented """
         try:
-            output = self.extractors[target.category](html, target=target, run_timestamp=self.run_timestamp)
+            output = await self.extract(target, html, from_cache)
         except AntiScrapingError as e:
-            amended_result = {
-                "outcome": FetchOutcome.ANTI_SCRAPING,
-                "reason": describe_exception(e),
-                "switch_agent": not from_cache,
-            }
+            amended_result = FetchResult(
+                FetchOutcome.ANTI_SCRAPING,
+                reason=describe_exception(e),
+                switch_agent=not from_cache,
+                from_cache=from_cache
+            )
         else:
             if "captcha_image_url" in output:
                 if from_cache:
-                    amended_result = {
-                        "outcome": FetchOutcome.ANTI_SCRAPING,
-                        "reason": "captcha challenge, from saved page",
-                        "switch_agent": False,
-                    }
+                    amended_result = FetchResult(
+                        FetchOutcome.ANTI_SCRAPING, reason="captcha challenge, from saved page", from_cache=True
+                    )
                 else:
-                    self.logger.info("captcha detected at {}, attempting to answer it...".format(target.url))
+                    self.logger.info("captcha detected at %s, attempting to answer it...", target.url)
                     result = await self.answer_captcha_challenge(challenge=output, referer=target.url)
 
                     if result["outcome"] == "success":
-                        amended_result = {
-                            "outcome": FetchOutcome.ANTI_SCRAPING,
-                            "reason": "captcha challenge, answered",
-                            "switch_agent": False,
-                        }
+                        amended_result = FetchResult(FetchOutcome.ANTI_SCRAPING, reason="captcha challenge, answered")
                     else:
-                        amended_result = {
-                            "outcome": FetchOutcome.ANTI_SCRAPING,
-                            "reason": "captcha challenge, unanswered due to {}".format(result["reason"]),
-                            "switch_agent": True,
-                        }
+                        amended_result = FetchResult(
+                            FetchOutcome.ANTI_SCRAPING,
+                            reason="captcha challenge, unanswered due to {}".format(result["reason"]),
+                            switch_agent=True
+                        )
             else:
-                self.logger.debug("extraction succeeded, harvesting from extracted content: {}".format(target.url))
-                await harvest(output, target, self.input_queue, self.run_timestamp)
-                amended_result = {"outcome": FetchOutcome.SUCCESS}
+                self.logger.debug("extraction succeeded, harvesting from extracted content: %s", target.url)
+                await harvest(output, target, self.send_many, self.visited, self.run_timestamp)
+                amended_result = FetchResult(FetchOutcome.SUCCESS, from_cache=from_cache)
 
-        amended_result["from_cache"] = from_cache
         return amended_result
 
     async def on_receive(self, target):
-        self.logger.debug("downloading content from {0} url {1}, keywords: {2}{3}".format(
-            target.category or '', target.url, target.keyword, ", retrying" if target.retry_count else ''))
+        self.logger.debug("downloading content from %s url %s, keywords: %s%s",
+                          target.category or '', target.url, target.keyword, ", retrying" if target.retry_count else '')
 
-        extra_headers = {"Referer": target.referer}
+        self.extra_headers["Referer"] = target.referer
 
         result = await self.download(
-            target.url, params=target.params, read_from_cache=not target.retry_count, extra_headers=extra_headers
+            target.url, params=target.params, read_from_cache=not target.retry_count, extra_headers=self.extra_headers,
+            priority=bool(target.retry_count)
         )
 
-        if result["outcome"] == FetchOutcome.SUCCESS and target.category:
+        if result.outcome == FetchOutcome.SUCCESS and target.category:
             # possibly changing the result upon further scrutiny
-            result = await self.handle_download_success(target, result["content"], result["from_cache"])
-        elif result["outcome"] == FetchOutcome.FAILURE:
-            self.logger.error("download failed: {0}, please analyze: {1}, skip to next one".format(target.url, result["reason"]))
+            result = await self.handle_download_success(target, result.content, result.from_cache)
+        elif result.outcome == FetchOutcome.FAILURE:
+            self.logger.error("download failed: %s, please analyze: %s, skip to next one", target.url, result.reason)
 
         # check if retry is required
-        if result["outcome"] not in (FetchOutcome.SUCCESS, FetchOutcome.FAILURE):
+        if result.outcome not in FINAL_OUTCOMES:
             if target.retry_count < RETRY_MAX:
-                self.logger.warning("download failed because of {0}, scheduling for retry: {1}".format(
-                    result["reason"], target.url))
-
-                await self.input_queue.put((TargetPriority.RETRY.value, Target(
-                    keyword=target.keyword,
-                    url=target.url,
-                    referer=target.referer,
-                    category=target.category,
-                    retry_count=target.retry_count + 1,
-                    follow_next_count=target.follow_next_count
-                )))
+                self.logger.warning("download failed because of %s, scheduling for retry: %s",
+                                    result.reason, target.url)
+
+                target.retry_count += 1
+                self.send(TargetPriority.RETRY.value, target)
 
             else:
-                self.logger.warning("download failed because of {0}, retried max number of times: {1}".format(
-                    result["reason"], target.url))
+                self.logger.warning("download failed because of %s, retried max number of times: %s",
+                                    result.reason, target.url)
 
         return result
 
     async def start(self):
         async with self.browser:
-            self.logger.info("starting browser {}".format(self.browser))
+            self.logger.info("starting browser %s", self.browser)
 
             proxy_failure_count = 0
 
             while True:
-                _, target = await self.input_queue.get()
+                if self.inbox:
+                    _, _, target = heappop(self.inbox)
+                else:
+                    target = await self.seed_queue.get()
 
                 if target is None:
                     break
 
                 result = await self.on_receive(target)
+                outcome = result.outcome
+
+                if outcome == FetchOutcome.SUCCESS:
+                    if not result.from_cache:
+                        proxy_failure_count = max(0, proxy_failure_count - PROXY_SUCCESS_REWARD)
+                    continue
 
-                if result["outcome"] == FetchOutcome.SUCCESS and not result["from_cache"]:
-                    proxy_failure_count = max(0, proxy_failure_count - PROXY_SUCCESS_REWARD)
-                elif result["outcome"] == FetchOutcome.MAYBE_PROXY_FAILURE:
+                if outcome == FetchOutcome.MAYBE_PROXY_FAILURE:
                     proxy_failure_count += 1
 
-                if proxy_failure_count > PROXY_FAILURE_COUNT_MAX or \
-                    result["outcome"] == FetchOutcome.ANTI_SCRAPING and result["switch_agent"] or \
-                    result["outcome"] == FetchOutcome.PROXY_FAILURE:
+                if proxy_failure_count > PROXY_FAILURE_COUNT_MAX or outcome == FetchOutcome.PROXY_FAILURE or \
+                    outcome == FetchOutcome.ANTI_SCRAPING and result.switch_agent:
 
-                    self.logger.warning("{0}, changing browser from {1}".format(result["outcome"].value, self.browser))
+                    self.logger.warning("%s, changing browser from %s", outcome.value, self.browser)
                     self.browser.switch_agent()
-                    self.logger.warning("to {}...".format(self.browser))
+                    self.logger.warning("to %s...", self.browser)
 
                     proxy_failure_count = 0
 
@@ -267,17 +372,22 @@ class Scraper:
 
 def gen_target_params(generate_search_url: Callable[[str], Tuple[str, str]], keyword_file: TextIO) \
         -> Generator[dict, None, None]:
-    """ yield target params {"keyword": ... "url": ..., "referer": ...} from keywords in <keyword_file> """
+    """ yield target params {"keyword": ... "url": ..., "referer": ...} from keywords in <keyword_file>,
+        each keyword once
+    """
+    seen = set()
+
     for line in keyword_file:
         keyword = line.strip()
 
-        if keyword:
+        if keyword and keyword not in seen:
+            seen.add(keyword)
             url, referer = generate_search_url(keyword)
             yield {"keyword": keyword, "url": url, "referer": referer}
 
 
 async def put_seed_urls(scrapers, generate_search_url, keyword_file=None):
-    """ send seed urls to scrapers in cycle
+    """ send seed urls to scrapers in cycle, SEED_BATCH_SIZE at a time
 
         scrapers: scraper actors
         generate_search_url:
@@ -287,8 +397,6 @@ async def put_seed_urls(scrapers, generate_search_url, keyword_file=None):
     """
     logger = logging.getLogger("rc_crawler.put_seed_urls")
 
-    scrapers_in_cycle = cycle(scrapers)
-
     if keyword_file:
         target_params = gen_target_params(generate_search_url, keyword_file)
     else:
@@ -298,10 +406,16 @@ async def put_seed_urls(scrapers, generate_search_url, keyword_file=None):
             logger.error("you did not specify a keyword file")
             raise
 
-    for params in target_params:
-        logger.debug("seed keyword: {keyword}".format(**params))
+    while True:
+        batch = [
+            Target(category=PageCategory.SEARCH.value, **params) for params in islice(target_params, SEED_BATCH_SIZE)
+        ]
+
+        if not batch:
+            break
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("seed keywords: %s", [target.keyword for target in batch])
 
-        await next(scrapers_in_cycle).send((
-            TargetPriority.DEFAULT.value,
-            Target(category=PageCategory.SEARCH.value, **params)
-        ))
+        # a scraper lagging behind does not hold up the seeding of the others
+        await asyncio.gather(*(sc.send_seeds(batch[i::len(scrapers)]) for i, sc in enumerate(scrapers)))
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from contextlib import AsyncExitStack
 from importlib import import_module
 import asyncio
 import inspect
@@ -8,8 +9,14 @@ import time
 
 import click
 
-from .browser import back_by_storage, limit_actions
-from .crawler import put_seed_urls, TargetPriority, Scraper
+from .browser import back_by_storage, limit_actions, create_session
+from .crawler import create_visited_filter, put_seed_urls, Scraper
+
+# libuv based event loop, used when installed
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 
 def configure_logging(platform: str) -> None:
@@ -37,10 +44,12 @@ def get_extractors(platform_module):
 
         returns: {page_category: function}
     """
+    prefix = "extract_"
+
     return {
-        n.lstrip("extract_"): f
-        for n, f in inspect.getmembers(platform_module, inspect.isfunction)
-        if n.startswith("extract_")
+        n[len(prefix):]: f
+        for n, f in vars(platform_module).items()
+        if n.startswith(prefix) and inspect.isfunction(f)
     }
 
 
@@ -60,11 +69,29 @@ def get_captcha_solver(platform_module):
         logger.info("loading captcha solver {0} with config {1}...".format(
             captcha_solver_module_name, captcha_solver_config))
 
-        CaptchaSolver = import_module('.captcha.' + captcha_solver_module_name, package="rc_crawler")
+        CaptchaSolver = import_module('.captcha.' + captcha_solver_module_name, package="rc_crawler").CaptchaSolver
         kwargs = {"config": captcha_solver_config} if captcha_solver_config else {}
         return CaptchaSolver(**kwargs)
 
 
+async def seed_scrapers(scrapers, generate_search_url, keyword_file):
+    """ send seed urls to <scrapers>, followed by the stoppers """
+    logger = logging.getLogger("rc_crawler")
+
+    logger.info("starting to generate seed urls{}...".format(
+        " from keyword file {} ".format(keyword_file.name) if keyword_file else ''))
+
+    await put_seed_urls(scrapers, generate_search_url, keyword_file)
+
+    logger.info("putting stoppers in queue for scrapers...")
+
+    for sc in scrapers:
+        # seeds are taken only when a scraper has nothing else to do, so the stopper comes last
+        await sc.send_seed(None)
+
+    logger.info("waiting for scrapers to complete all tasks...")
+
+
 async def start_crawler(platform_module, keyword_file, run_timestamp, num_scrapers):
     """ assemble and start all the components of the crawler
 
@@ -81,34 +108,47 @@ async def start_crawler(platform_module, keyword_file, run_timestamp, num_scrape
 
     logger.info("starting {} scrapers...".format(num_scrapers))
 
-    scrapers = [Scraper(
-        run_timestamp,
-        platform_module.CRAWL_DEVICE_TYPE,
-        get_extractors(platform_module),
-        middlewares=[limit_actions(platform_module.RATE_LIMIT_PARAMS), back_by_storage(run_timestamp)],
-        captcha_solver=captcha_solver
-    ) for i in range(num_scrapers)]
+    extractors = get_extractors(platform_module)
 
-    scraping_tasks = asyncio.ensure_future(asyncio.gather(*[sc.start() for sc in scrapers]))
+    # a listing found by several scrapers is followed only once
+    visited = create_visited_filter()
 
-    logger.info("starting to generate seed urls{}...".format(
-        " from keyword file {} ".format(keyword_file.name) if keyword_file else ''))
+    async with AsyncExitStack() as stack:
+        # one connection pool for the whole crawl, closed after the scrapers are done
+        session = await stack.enter_async_context(create_session())
 
-    await put_seed_urls(scrapers, platform_module.generate_search_url, keyword_file)
+        if captcha_solver:
+            # the solver is set up before any scraper starts, as seeding lasts nearly as long as the crawl
+            await stack.enter_async_context(captcha_solver)
 
-    logger.info("putting stoppers in queue for scrapers...")
+        scrapers = [Scraper(
+            run_timestamp,
+            platform_module.CRAWL_DEVICE_TYPE,
+            extractors,
+            session,
+            middlewares=[limit_actions(platform_module.RATE_LIMIT_PARAMS), back_by_storage(run_timestamp)],
+            captcha_solver=captcha_solver,
+            visited=visited
+        ) for i in range(num_scrapers)]
 
-    for sc in scrapers:
-        # put lower priority, so that urls are processed first
-        await sc.send((TargetPriority.STOPPER.value, None))
+        scraping_tasks = [asyncio.ensure_future(sc.start()) for sc in scrapers]
 
-    logger.info("waiting for scrapers to complete all tasks...")
+        # seeding runs alongside the scrapers, the seed queues being bounded it would wait forever on a dead one
+        seeding_task = asyncio.ensure_future(seed_scrapers(scrapers, platform_module.generate_search_url, keyword_file))
+
+        done, pending = await asyncio.wait([seeding_task, *scraping_tasks], return_when=asyncio.FIRST_EXCEPTION)
 
-    if captcha_solver:
-        with captcha_solver:
-            await scraping_tasks
-    else:
-        await scraping_tasks
+        if pending:
+            logger.error("crawler stopped by an error, cancelling the remaining tasks...")
+
+        for task in pending:
+            task.cancel()
+
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        for task in done:
+            # raises the error that stopped the crawl, if any
+            task.result()
 
     logger.info("exiting crawler...")
 
@@ -125,7 +165,18 @@ def main(platform: str, *args, **kwargs) -> None:
 
     crawler = start_crawler(platform_module, *args, **kwargs)
 
-    loop = asyncio.get_event_loop()
+    if uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # the loop is created explicitly, uvloop's policy does not create one in get_event_loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # tasks run eagerly up to their first suspension, those done by then (e.g. a seeding into a
+    # scraper with room in its queue) never go through the event loop, available from python 3.12
+    if hasattr(asyncio, "eager_task_factory"):
+        loop.set_task_factory(asyncio.eager_task_factory)
+
     loop.run_until_complete(crawler)
     loop.close()
 
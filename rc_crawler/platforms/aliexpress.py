@@ -1,12 +1,16 @@
 from typing import Tuple
+from urllib.parse import quote_plus
+import re
 
-from lxml.html import document_fromstring, HtmlElement
+from selectolax.lexbor import LexborHTMLParser
 
 from rc_crawler.crawler import Target, AntiScrapingError
+from .dom import parse_html, parse_head, select_first, select_text, select_attr
 
 
 BASE_URL = "http://www.aliexpress.com"
 SEARCH_URL_TEMPLATE = "/wholesale?catId=0&initiative_id=&SearchText={}"
+SEARCH_URL_PREFIX, SEARCH_URL_SUFFIX = (BASE_URL + SEARCH_URL_TEMPLATE).split("{}")
 FOLLOW_NEXT_MAX = 2
 
 CRAWL_DEVICE_TYPE = "desktop"
@@ -17,22 +21,26 @@ RATE_LIMIT_PARAMS = [
     {"max_rate": 150, "time_period": 1*60*60}
 ]
 
+NON_DIGITS_RE = re.compile(r"\D+")
+
 
 def generate_search_url(keyword: str) -> Tuple[str, str]:
     """ Returns search url, referer url """
-    return BASE_URL + SEARCH_URL_TEMPLATE.format(keyword.replace(' ', '+')), BASE_URL + '/'
+    return SEARCH_URL_PREFIX + quote_plus(keyword) + SEARCH_URL_SUFFIX, BASE_URL + '/'
 
 
-def read_html(extractor):
-    def wrapped(html, *args, **kwargs):
-        if len(html) < 14496:
-            raise AntiScrapingError("Server is returning a blocked page")
+def read_html(parse=parse_html):
+    def decorator(extractor):
+        def wrapped(html, *args, **kwargs):
+            if len(html) < 14496:
+                raise AntiScrapingError("Server is returning a blocked page")
 
-        tree = document_fromstring(html)
+            tree = parse(html)
 
-        return extractor(tree, *args, **kwargs)
+            return extractor(tree, *args, **kwargs)
 
-    return wrapped
+        return wrapped
+    return decorator
 
 
 def _extract_price_distribution(tree):
@@ -40,24 +48,31 @@ def _extract_price_distribution(tree):
         tree: html element tree
         returns: {(price_from, price_to): percentage}
     """
-    price_histogram = tree.cssselect("#price-range-list > li")
+    price_histogram = tree.css_first("#price-range-list")
     price_distribution = {}
 
+    if price_histogram is None:
+        return price_distribution
+
     try:
-        for el in price_histogram:
-            range_el = el.find_class("histogram-height")[0]
+        # walk the children one at a time, rather than building a node for every <li> upfront
+        for el in price_histogram.iter():
+            if el.tag != "li":
+                continue
+
+            range_attrs = select_first(el, ".histogram-height").attributes
 
             try:
-                price_from = float(range_el.attrib["price-range-from"])
-            except ValueError:
+                price_from = float(range_attrs["price-range-from"])
+            except (TypeError, ValueError):
                 price_from = None
 
             try:
-                price_to = float(range_el.attrib["price-range-to"])
-            except ValueError:
+                price_to = float(range_attrs["price-range-to"])
+            except (TypeError, ValueError):
                 price_to = None
 
-            percentage_str = el.find_class("ui-histogram-ballon")[0].text_content()
+            percentage_str = select_text(el, ".ui-histogram-ballon")
             percentage = float(percentage_str.split('%')[0])
 
             price_distribution[(price_from, price_to)] = percentage
@@ -67,14 +82,14 @@ def _extract_price_distribution(tree):
     return price_distribution
 
 
-@read_html
-def extract_search_results(tree: HtmlElement, target: Target, **kwargs) -> dict:
+@read_html()
+def extract_search_results(tree: LexborHTMLParser, target: Target, **kwargs) -> dict:
     """ Returns a dictionary of useful info from search results <tree> """
     output = {}
 
     try:
-        total_listings_str = tree.cssselect(".search-count")[0].text_content()
-        output["total_listings"] = int(''.join(c for c in total_listings_str if c.isdigit()))
+        total_listings_str = select_text(tree, ".search-count")
+        output["total_listings"] = int(NON_DIGITS_RE.sub('', total_listings_str))
     except (IndexError, ValueError):
         output["total_listings"] = None
 
@@ -82,23 +97,23 @@ def extract_search_results(tree: HtmlElement, target: Target, **kwargs) -> dict:
 
     if target.follow_next_count < FOLLOW_NEXT_MAX:
         try:
-            output["next_url"] = "http:" + tree.cssselect("a.page-next")[0].attrib["href"].lstrip()
+            href = select_attr(tree, "a.page-next", "href").lstrip()
         except (IndexError, KeyError):
-            output["next_url"] = None
+            href = None
 
-    try:
-        output["listing_urls"] = {"http:" + link.attrib["href"].lstrip() for link in tree.cssselect("a.product")}
-    except KeyError:
-        output["listing_urls"] = set()
+        output["next_url"] = "http:" + href if href else None
+
+    hrefs = (link.attributes.get("href") for link in tree.css("a.product"))
+    output["listing_urls"] = {"http:" + href.lstrip() for href in hrefs if href}
 
     return output
 
 
-@read_html
-def extract_listing(tree: HtmlElement, **kwargs) -> dict:
+@read_html(parse=parse_head)
+def extract_listing(tree: LexborHTMLParser, **kwargs) -> dict:
     """ Returns a dictionary of useful info from listing page <tree> """
     try:
-        title = tree.cssselect("title")[0].text_content()
+        title = select_text(tree, "title")
     except IndexError:
         title = None
 
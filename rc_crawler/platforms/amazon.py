@@ -1,15 +1,19 @@
 from typing import Tuple
+from urllib.parse import quote_plus
 import logging
+import re
 
-from lxml.html import document_fromstring, tostring, HtmlElement
+from selectolax.lexbor import LexborHTMLParser
 
 from rc_crawler.crawler import Target, AntiScrapingError
+from .dom import parse_html, parse_head, select_first, select_text, select_attr, form_fields
 
 logger = logging.getLogger("rc_crawler.amazon")
 
 
 BASE_URL = "http://www.amazon.com"
 SEARCH_URL_TEMPLATE = "/s/ref=nb_sb_noss?url=search-alias%3Daps&field-keywords={}"
+SEARCH_URL_PREFIX, SEARCH_URL_SUFFIX = (BASE_URL + SEARCH_URL_TEMPLATE).split("{}")
 FOLLOW_NEXT_MAX = 5
 
 CRAWL_DEVICE_TYPE = "mobile"
@@ -24,99 +28,107 @@ RATE_LIMIT_PARAMS = [
 CAPTCHA_SOLVER = "tesseract_ocr"
 CAPTCHA_SOLVER_CONFIG = "-psm 6 uppercase_letters"
 
+NON_DIGITS_RE = re.compile(r"\D+")
+
 
 def generate_search_url(keyword: str) -> Tuple[str, str]:
     """ Returns search url, referer url """
-    return BASE_URL + SEARCH_URL_TEMPLATE.format(keyword.replace(' ', '+')), BASE_URL + '/'
+    return SEARCH_URL_PREFIX + quote_plus(keyword) + SEARCH_URL_SUFFIX, BASE_URL + '/'
 
 
 def _extract_captcha_challenge(tree, **kwargs):
     """ Returns information needed for answering a captcha challenge """
     try:
-        form = tree.cssselect("form")[0]
-        captcha_image_url = form.cssselect("img")[0].attrib["src"]
+        form = select_first(tree, "form")
+        captcha_image_url = select_attr(form, "img", "src")
     except (IndexError, KeyError) as e:
         raise AntiScrapingError("Unable to find captcha image url on the challenge page") from e
 
+    if not captcha_image_url:
+        raise AntiScrapingError("Empty captcha image url on the challenge page")
+
     return {
         "captcha_image_url": captcha_image_url,
 
         "submission_form": {
-            "action": BASE_URL + form.action,
-            "method": form.method,
-            "data": dict(form.fields),
+            "action": BASE_URL + (form.attributes.get("action") or ''),
+            "method": (form.attributes.get("method") or "GET").upper(),
+            "data": form_fields(form),
         }
     }
 
 
-def read_html(extractor):
-    def wrapped(html, *args, **kwargs):
-        if len(html) < 7218:
-            extractor_to_use = _extract_captcha_challenge
-        else:
-            extractor_to_use = extractor
-
-        tree = document_fromstring(html)
+def read_html(parse=parse_html):
+    def decorator(extractor):
+        def wrapped(html, *args, **kwargs):
+            if len(html) < 7218:
+                # the challenge form is in <body>, always parse the whole page
+                extractor_to_use, tree = _extract_captcha_challenge, parse_html(html)
+            else:
+                extractor_to_use, tree = extractor, parse(html)
 
-        return extractor_to_use(tree, *args, **kwargs)
+            return extractor_to_use(tree, *args, **kwargs)
 
-    return wrapped
+        return wrapped
+    return decorator
 
 
 def _has_results(tree):
     try:
-        return "sorry" not in tree.cssselect("#results h4")[0].text_content()
+        return "sorry" not in select_text(tree, "#results h4")
     except IndexError:
         return True
 
 
-@read_html
-def extract_search_results(tree: HtmlElement, target: Target, **kwargs) -> dict:
+@read_html()
+def extract_search_results(tree: LexborHTMLParser, target: Target, **kwargs) -> dict:
     """ Returns a dictionary of useful info from search results <tree> """
     output = {}
 
     if _has_results(tree):
         try:
-            total_listings_str = tree.cssselect("#s-slick-result-header span")[0].text_content()
-            output["total_listings"] = int(''.join(c for c in total_listings_str if c.isdigit()))
+            total_listings_str = select_text(tree, "#s-slick-result-header span")
+            output["total_listings"] = int(NON_DIGITS_RE.sub('', total_listings_str))
         except (IndexError, ValueError):
             output["total_listings"] = None
 
         if target.follow_next_count < FOLLOW_NEXT_MAX:
             try:
-                next_url_button = tree.cssselect(".a-pagination > li:nth-child(2)")[0]
+                next_url_button = select_first(tree, ".a-pagination > li:nth-child(2)")
 
-                if "a-disabled" not in next_url_button.classes:
-                    output["next_url"] = BASE_URL + next_url_button.cssselect('a')[0].attrib["href"].lstrip()
+                if "a-disabled" not in (next_url_button.attributes.get("class") or '').split():
+                    href = select_attr(next_url_button, "a", "href").lstrip()
+                    output["next_url"] = BASE_URL + href if href else None
 
             except (IndexError, KeyError):
                 output["next_url"] = None
 
         output["listing_urls"] = set()
-        listings = tree.cssselect("#resultItems > li") # linear layout
+        listings = tree.css("#resultItems > li") # linear layout
 
         if listings:
             for li in listings:
                 try:
-                    listing_url = BASE_URL + li.cssselect("a.aw-search-results")[0].attrib["href"].lstrip()
+                    href = select_attr(li, "a.aw-search-results", "href").lstrip()
                 except (IndexError, KeyError) as e:
-                    logger.warning("could not extract listing url from {0}, target: {1}".format(tostring(li), target))
+                    logger.warning("could not extract listing url from %s, target: %s", li.html, target)
                     logger.exception(e)
                 else:
-                    output["listing_urls"].add(listing_url)
+                    if href:
+                        output["listing_urls"].add(BASE_URL + href)
 
-        elif tree.cssselect("#resultItems li"):
-            logger.error("multi-item row layout detected, for which listing urls extraction logic is not implemented, target: {}".format(
-                target))
+        elif tree.css_first("#resultItems li"):
+            logger.error("multi-item row layout detected, for which listing urls extraction logic is not implemented, "
+                         "target: %s", target)
 
     return output
 
 
-@read_html
-def extract_listing(tree: HtmlElement, **kwargs) -> dict:
+@read_html(parse=parse_head)
+def extract_listing(tree: LexborHTMLParser, **kwargs) -> dict:
     """ Returns a dictionary of useful info from listing page <tree> """
     try:
-        title = tree.cssselect("title")[0].text_content()
+        title = select_text(tree, "title")
     except IndexError:
         title = None
 
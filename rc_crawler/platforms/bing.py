@@ -1,28 +1,61 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Tuple
+from urllib.parse import quote_plus
 import logging
 import re
 
-from lxml.html import document_fromstring
 import dateparser
 
+from .dom import parse_html
+
 logger = logging.getLogger("rc_crawler.bing")
 
 
 BASE_URL = "http://www.bing.com"
 SEARCH_URL_TEMPLATE = "/videos/search?q={}&FORM=BVLH1"
+SEARCH_URL_PREFIX, SEARCH_URL_SUFFIX = (BASE_URL + SEARCH_URL_TEMPLATE).split("{}")
 
 CRAWL_DEVICE_TYPE = "desktop"
 
 # reqs / secs
 RATE_LIMIT_PARAMS = [{"max_rate": 2, "time_period": 10}]
 
-VIDEO_INFO_RE = re.compile(r"(?P<title>[^·]+) from [^·]+|(?P<views>[\d,]+)\+? views|uploaded on (?P<uploaded_on>[^·]+)")
+# matched at the start of each ·-separated fragment, surrounding blanks excluded, in one pass over the string
+VIDEO_INFO_RE = re.compile(
+    r"(?:^|·)\s*(?:(?P<title>[^·]+) from [^·]+|(?P<views>[\d,]+)\+? views|uploaded on (?P<uploaded_on>[^·]*[^·\s]))"
+)
+
+# the common relative dates, worked out without dateparser. months and years are left to it, not being fixed lengths
+RELATIVE_DATE_RE = re.compile(r"(?P<amount>\d+) (?P<unit>minute|hour|day|week)s? ago$")
+
+# the same upload dates recur across the videos of a crawl
+UPLOADED_ON_CACHE_SIZE = 4096
 
 
 def generate_search_url(keyword: str) -> Tuple[str, str]:
     """ Returns search url, referer url """
-    return BASE_URL + SEARCH_URL_TEMPLATE.format(keyword.replace(' ', '+')), BASE_URL + '/'
+    return SEARCH_URL_PREFIX + quote_plus(keyword) + SEARCH_URL_SUFFIX, BASE_URL + '/'
+
+
+@lru_cache(maxsize=UPLOADED_ON_CACHE_SIZE)
+def parse_uploaded_on(uploaded_on_str, relative_base):
+    """ Parses <uploaded_on_str> assuming now is <relative_base>
+
+        returns datetime, or None if it can't parse.
+    """
+    try:
+        return datetime.strptime(uploaded_on_str, "%d/%m/%Y")
+    except ValueError:
+        pass
+
+    m = RELATIVE_DATE_RE.match(uploaded_on_str)
+
+    if m and relative_base:
+        return relative_base - timedelta(**{m.group("unit") + "s": int(m.group("amount"))})
+
+    # try intelligent parser
+    return dateparser.parse(uploaded_on_str, settings={"RELATIVE_BASE": relative_base})
 
 
 def parse_video_info_string(video_info_str, relative_base=False):
@@ -33,15 +66,10 @@ def parse_video_info_string(video_info_str, relative_base=False):
         returns title, views, uploaded_on in a dictionary.
         value is None, if missing or can't parse.
     """
-    fragments = video_info_str.split('·')
-
     result = {"title": None, "views": None, "uploaded_on": None}
 
-    for s in fragments:
-        m = VIDEO_INFO_RE.match(s.strip())
-
-        if m:
-            result.update({k: v for k, v in m.groupdict().items() if v})
+    for m in VIDEO_INFO_RE.finditer(video_info_str):
+        result.update({k: v for k, v in m.groupdict().items() if v})
 
     if result["views"]:
         try:
@@ -50,37 +78,34 @@ def parse_video_info_string(video_info_str, relative_base=False):
             result["views"] = None
 
     if result["uploaded_on"]:
-        try:
-            result["uploaded_on"] = datetime.strptime(result["uploaded_on"], "%d/%m/%Y")
-        except ValueError:  # try intelligent parser
-            result["uploaded_on"] = dateparser.parse(result["uploaded_on"], settings={"RELATIVE_BASE": relative_base})
+        # without a fixed base, "now" moves on and the result must not be cached
+        parse = parse_uploaded_on if relative_base else parse_uploaded_on.__wrapped__
+        result["uploaded_on"] = parse(result["uploaded_on"], relative_base)
 
     return result
 
 
 def extract_search_results(html: str, run_timestamp: int, **kwargs) -> dict:
     """ Returns a dictionary of useful info from search results <html> """
-    tree = document_fromstring(html)
+    tree = parse_html(html)
 
     videos_info = []
 
-    try:
-        videos_info_strings = [el.attrib["aria-label"] for el in tree.cssselect("a.dv_i")]
-    except KeyError:
-        pass
-    else:
-        for s in videos_info_strings:
-            result = parse_video_info_string(s, relative_base=datetime.utcfromtimestamp(run_timestamp))
+    # a video link without its aria-label (or with an empty one) is skipped, the others are still parsed
+    labels = (el.attributes.get("aria-label") for el in tree.css("a.dv_i"))
+
+    for s in filter(None, labels):
+        result = parse_video_info_string(s, relative_base=datetime.utcfromtimestamp(run_timestamp))
 
-            if result["views"] and result["uploaded_on"]:
-                videos_info.append(result)
-            else:
-                logger.warning("incomplete parsing of video info: {}".format(s))
+        if result["views"] and result["uploaded_on"]:
+            videos_info.append(result)
+        else:
+            logger.warning("incomplete parsing of video info: %s", s)
 
-                if not result["views"] and " views" in s:
-                    logger.error("regex unable to extract view count from video info: {}".format(s))
+            if not result["views"] and " views" in s:
+                logger.error("regex unable to extract view count from video info: %s", s)
 
-                if not result["uploaded_on"] and "uploaded on" in s:
-                    logger.error("regex unable to extract uploaded_on from video info: {}".format(s))
+            if not result["uploaded_on"] and "uploaded on" in s:
+                logger.error("regex unable to extract uploaded_on from video info: %s", s)
 
     return {"videos_info": videos_info}
@@ -0,0 +1,44 @@
+from selectolax.lexbor import LexborHTMLParser, LexborNode
+
+
+def parse_html(html: str) -> LexborHTMLParser:
+    """ parse <html> with Lexbor, the tree stays in C and nodes are only built when selected """
+    return LexborHTMLParser(html)
+
+
+def parse_head(html: str) -> LexborHTMLParser:
+    """ parse only the <head> section of <html>, which is enough for reading <title> """
+    head_end = html.find("</head>")
+    return parse_html(html[:head_end] if head_end != -1 else html)
+
+
+def select_first(node: LexborNode, selector: str) -> LexborNode:
+    """ returns the first element under <node> matching <selector>, the search stops there
+        raises IndexError if there is no match
+    """
+    match = node.css_first(selector)
+
+    if match is None:
+        raise IndexError("no element matches {}".format(selector))
+
+    return match
+
+
+def select_text(node: LexborNode, selector: str) -> str:
+    """ returns text content of the first element under <node> matching <selector>
+        raises IndexError if there is no match
+    """
+    return select_first(node, selector).text()
+
+
+def select_attr(node: LexborNode, selector: str, name: str) -> str:
+    """ returns attribute <name> of the first element under <node> matching <selector>,
+        an empty string if the attribute has no value (e.g. <a href>)
+        raises IndexError if there is no match, KeyError if the attribute is missing
+    """
+    return select_first(node, selector).attributes[name] or ""
+
+
+def form_fields(form: LexborNode) -> dict:
+    """ returns {name: value} of the named input fields in <form>, value is None if not filled """
+    return {el.attributes["name"]: el.attributes.get("value") for el in form.css("input[name]")}
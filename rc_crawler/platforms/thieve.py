@@ -1,5 +1,6 @@
 from typing import Generator
-from lxml.html import document_fromstring
+
+from .dom import parse_html, select_text
 
 
 BASE_URL = "http://thieve.co"
@@ -22,18 +23,18 @@ def generate_search_url() -> Generator[dict, None, None]:
 
 def _extract_product_item(item):
     try:
-        title = item.cssselect(".title")[0].text_content()
-    except KeyError:
+        title = select_text(item, ".title")
+    except IndexError:
         title = None
 
     try:
-        price = float(item.cssselect(".price")[0].text_content()[1:])
-    except (KeyError, ValueError):
+        price = float(select_text(item, ".price")[1:])
+    except (IndexError, ValueError):
         price = None
 
     try:
-        like_count = int(item.cssselect(".like-count")[0].text_content())
-    except (KeyError, ValueError):
+        like_count = int(select_text(item, ".like-count"))
+    except (IndexError, ValueError):
         like_count = None
 
     if title:
@@ -42,6 +43,6 @@ def _extract_product_item(item):
 
 def extract_search_results(html: str, **kwargs) -> dict:
     """ Returns a dictionary of useful info from search results <html> """
-    tree = document_fromstring(html)
-    products = filter(bool, map(_extract_product_item, tree.cssselect(".product-feed .product-item")))
+    tree = parse_html(html)
+    products = filter(bool, map(_extract_product_item, tree.css(".product-feed .product-item")))
     return {"products": list(products)}
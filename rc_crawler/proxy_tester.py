@@ -1,27 +1,39 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 import asyncio
 import logging
 
 import aiohttp
-import async_timeout
 import click
 
 from .browser import HEADERS, USER_AGENTS
 
+# libuv based event loop, used when installed
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 fh = logging.FileHandler("proxy_tester.log")
 fh.setLevel(logging.DEBUG)
 
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 fh.setFormatter(formatter)
 
+# records are written to file by the listener's thread, the event loop only enqueues them
+log_queue = SimpleQueue()
+log_listener = QueueListener(log_queue, fh, respect_handler_level=True)
+qh = QueueHandler(log_queue)
+
 logger = logging.getLogger("proxy_tester")
 logger.setLevel(logging.DEBUG)
-logger.addHandler(fh)
+logger.addHandler(qh)
 
 logger2 = logging.getLogger("rc_crawler")
 logger2.setLevel(logging.DEBUG)
-logger2.addHandler(fh)
+logger2.addHandler(qh)
 
 
 NUM_THREADS = 80
@@ -54,48 +66,68 @@ async def dump_proxy_in_queue(proxy_list, input_queue):
         if ip and ip not in seen:
             seen.add(ip)
 
-            logger.debug("IP: {}".format(ip))
+            logger.debug("IP: %s", ip)
             await input_queue.put("http://" + ip)
 
 
-async def test_connect(input_queue):
-    while True:
-        proxy = await input_queue.get()
+async def probe(session, proxy, url):
+    """ returns True if <url> is fetched successfully through <proxy> """
+    logger.info("sending request to %s with proxy %s...", url, proxy)
+
+    try:
+        async with session.get(url, proxy=proxy) as response:
+            await response.read()
+
+            if response.status == 200:
+                logger.info("proxy: %s, url: %s, success", proxy, url)
+                return True
+
+            logger.warning("proxy: %s, url: %s, issue: %s", proxy, url, response.status)
+
+    except Exception as e:
+        logger.warning("proxy: %s, url: %s, error: %s because of %s, %s",
+                       proxy, url, type(e).__name__, type(e.__cause__).__name__, e)
+
+    return False
 
-        if proxy is None:
-            break
 
-        logger.info("starting aiohttp client session...")
+async def test_proxy(session, proxy):
+    """ test <proxy> against TEST_URLS, print it if it is good """
+    # all test urls at once, a proxy takes as long as its slowest url instead of the sum of them
+    probes = [asyncio.ensure_future(probe(session, proxy, url)) for url in TEST_URLS]
+    error_count = 0
 
-        async with aiohttp.ClientSession(headers=HEADERS) as session:
-            error_count = 0
+    try:
+        for next_probe in asyncio.as_completed(probes):
+            if not await next_probe:
+                error_count += 1
 
-            for url in TEST_URLS:
-                logger.info("sending request to {0} with proxy {1}...".format(url, proxy))
+                # the proxy is bad already, no need to wait for the rest
+                if error_count > MAX_ERROR_COUNT:
+                    break
+    finally:
+        for p in probes:
+            p.cancel()
 
-                try:
-                    with async_timeout.timeout(20):
-                        async with session.get(url, proxy=proxy) as response:
-                            await response.read()
+        # wait for the cancelled probes to unwind, their outcomes are of no use now
+        await asyncio.gather(*probes, return_exceptions=True)
 
-                            if response.status == 200:
-                                logger.info("proxy: {0}, url: {1}, success".format(proxy, url))
-                            else:
-                                logger.warning("proxy: {0}, url: {1}, issue: {2}".format(proxy, url, response.status))
-                                error_count += 1
+    if error_count <= MAX_ERROR_COUNT:
+        logger.info("%s is good", proxy)
+        print(proxy)
+    else:
+        logger.warning("%s is bad", proxy)
 
-                except Exception as e:
-                    logger.warning("proxy: {0}, url: {1}, error: {2} because of {3}, {4}".format(
-                        proxy, url, type(e).__name__, type(e.__cause__).__name__, str(e)))
-                    error_count += 1
 
-            if error_count <= MAX_ERROR_COUNT:
-                logger.info("{0} is good".format(proxy))
-                print(proxy)
-            else:
-                logger.warning("{0} is bad".format(proxy))
+async def test_connect(input_queue, session):
+    """ test the proxies taken from <input_queue> until cancelled, printing the good ones """
+    while True:
+        proxy = await input_queue.get()
 
-    logger.info("exiting tester...")
+        try:
+            await test_proxy(session, proxy)
+        finally:
+            input_queue.task_done()
 
 
 async def start_proxy_tester(proxy_list):
@@ -104,20 +136,33 @@ async def start_proxy_tester(proxy_list):
     """
     logger.info("starting proxy tester...")
 
-    input_queue = asyncio.Queue()
-    testers = [test_connect(input_queue) for i in range(NUM_THREADS)]
-    tasks = asyncio.ensure_future(asyncio.gather(*testers))
+    # bounded, the proxy list is read only as fast as the testers get through it
+    input_queue = asyncio.Queue(maxsize=NUM_THREADS * 2)
+
+    # one connection pool and dns cache for all testers, connections through the same proxy to a host are reused
+    connector = aiohttp.TCPConnector(
+        limit=NUM_THREADS * 4, limit_per_host=4, ttl_dns_cache=300, enable_cleanup_closed=True)
+
+    logger.info("starting aiohttp client session...")
+
+    # each request, redirects and reading included, is given up after 20s
+    timeout = aiohttp.ClientTimeout(total=20)
 
-    logger.info("starting to dump proxy server URL to queue...")
-    await dump_proxy_in_queue(proxy_list, input_queue)
+    async with aiohttp.ClientSession(headers=HEADERS, connector=connector, timeout=timeout) as session:
+        testers = [asyncio.ensure_future(test_connect(input_queue, session)) for i in range(NUM_THREADS)]
 
-    logger.info("putting stoppers in queue for testers...")
+        logger.info("starting to dump proxy server URL to queue...")
+        await dump_proxy_in_queue(proxy_list, input_queue)
 
-    for _ in range(NUM_THREADS):
-        await input_queue.put(None)
+        logger.info("waiting for testers to complete all tasks...")
+        await input_queue.join()
 
-    logger.info("waiting for testers to complete all tasks...")
-    await tasks
+        logger.info("exiting testers...")
+
+        for tester in testers:
+            tester.cancel()
+
+        await asyncio.gather(*testers, return_exceptions=True)
 
     logger.info("exiting proxy tester...")
 
@@ -128,9 +173,19 @@ def main(proxy_list):
     """ test whether a proxy is functional """
     proxy_tester = start_proxy_tester(proxy_list)
 
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(proxy_tester)
-    loop.close()
+    if uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # the loop is created explicitly, uvloop's policy does not create one in get_event_loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    log_listener.start()
+
+    try:
+        loop.run_until_complete(proxy_tester)
+    finally:
+        loop.close()
+        log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -1,3 +1,29 @@
+from functools import lru_cache
+from urllib.parse import urlsplit, urlunsplit
+
+import orjson
+
+# query params added for tracking, which do not change the page
+TRACKING_PARAM_PREFIXES = ("utm_",)
+NORMALIZED_URL_CACHE_SIZE = 65536
+
+
+def json_dumps(obj) -> str:
+    """ json serializer for aiohttp sessions, which expect str """
+    return orjson.dumps(obj).decode()
+
+
+@lru_cache(maxsize=NORMALIZED_URL_CACHE_SIZE)
+def normalize_url(url: str) -> str:
+    """ returns <url> with lower-cased scheme and host, sorted query params, without tracking params and fragment,
+        so that links to the same page are followed once
+    """
+    parts = urlsplit(url)
+    params = sorted(p for p in parts.query.split('&') if p and not p.startswith(TRACKING_PARAM_PREFIXES))
+
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, '&'.join(params), ''))
+
+
 def describe_exception(e):
     msg = str(e)
     description = type(e).__name__
@@ -10,10 +36,3 @@ def describe_exception(e):
 
     return description
 
-
-class DummyAsyncContextManager:
-    async def __aenter__(self):
-        return self
-
-    async def __aexit__(self, exc_type, exc, tb):
-        pass
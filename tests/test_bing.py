@@ -80,3 +80,22 @@ def test_parse_video_info_string():
         "views": None,
         "uploaded_on": datetime(2012, 12, 20)
     }
+
+
+def test_generate_search_url():
+    assert bing.generate_search_url("red wine & café") == (
+        "http://www.bing.com/videos/search?q=red+wine+%26+caf%C3%A9&FORM=BVLH1",
+        "http://www.bing.com/"
+    )
+
+
+def test_extract_search_results():
+    html = (
+        '<a class="dv_i" aria-label="Faux Leather Belt Tutorial from YouTube · 1,000+ views · uploaded on 22/9/2016"></a>'
+        '<a class="dv_i" aria-label></a>'
+        '<a class="dv_i"></a>'
+    )
+
+    assert bing.extract_search_results(html, run_timestamp=0) == {
+        "videos_info": [{"title": "Faux Leather Belt Tutorial", "views": 1000, "uploaded_on": datetime(2016, 9, 22)}]
+    }
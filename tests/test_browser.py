@@ -0,0 +1,84 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import pytest
+import rc_crawler.browser.browser as br
+
+
+@pytest.fixture
+def no_proxy(monkeypatch):
+    monkeypatch.setattr(br, "renew_agent", lambda device_type: ("test agent", None))
+
+
+def fetch_from(handlers, path, **kwargs):
+    """ returns the FetchResult of fetching <path> from a local server with <handlers> by path """
+    app = web.Application()
+
+    for p, handler in handlers.items():
+        app.router.add_get(p, handler)
+
+    async def run():
+        async with TestServer(app, host="localhost") as server:
+            async with br.create_session() as session:
+                async with br.Browser("desktop", session) as browser:
+                    return await browser.fetch(str(server.make_url(path)), **kwargs)
+
+    return asyncio.run(run())
+
+
+def test_decode_text():
+    assert br.decode_text("café".encode("latin-1"), "latin-1") == "café"
+    assert br.decode_text("café".encode(), None) == "café"
+
+    # unknown charset declared by the server
+    assert br.decode_text("café".encode(), "bogus") == "café"
+    assert br.decode_text(b"caf\xe9", "bogus") == "caf�"
+
+
+def test_fetch_json(no_proxy):
+    async def ok(request):
+        return web.json_response({"a": 1})
+
+    async def error_page(request):
+        return web.Response(status=503, text="<html>busy</html>", content_type="text/html")
+
+    async def broken(request):
+        return web.Response(text="<html>not json</html>", content_type="text/html")
+
+    handlers = {"/ok": ok, "/error_page": error_page, "/broken": broken}
+
+    assert fetch_from(handlers, "/ok", filetype="json").content == {"a": 1}
+    assert fetch_from(handlers, "/error_page", filetype="json") == br.FetchResult(br.FetchOutcome.RETRY, reason=503)
+    assert fetch_from(handlers, "/broken", filetype="json").outcome == br.FetchOutcome.RETRY
+
+
+def test_fetch_redirect_cookies(no_proxy):
+    received = {}
+
+    async def start(request):
+        received["start"] = dict(request.cookies)
+        redirect = web.HTTPFound("/next")
+        redirect.set_cookie("session", "abc")
+        raise redirect
+
+    async def next_hop(request):
+        received["next"] = dict(request.cookies)
+        # same server, another site
+        raise web.HTTPFound("http://127.0.0.1:{}/end".format(request.url.port))
+
+    async def end(request):
+        received["end"] = dict(request.cookies)
+        return web.Response(text="done")
+
+    result = fetch_from({"/start": start, "/next": next_hop, "/end": end}, "/start")
+
+    assert result.content == "done"
+    assert received == {"start": {}, "next": {"session": "abc"}, "end": {}}
+
+
+def test_fetch_too_many_redirects(no_proxy):
+    async def loop(request):
+        raise web.HTTPFound("/loop")
+
+    assert fetch_from({"/loop": loop}, "/loop").outcome == br.FetchOutcome.RETRY
@@ -0,0 +1,30 @@
+import pytest
+import rc_crawler.platforms.dom as dom
+
+
+def test_parse_head():
+    tree = dom.parse_head("<html><head><title>Hello</title></head><body><p>World</p></body></html>")
+    assert dom.select_text(tree, "title") == "Hello"
+
+    with pytest.raises(IndexError):
+        dom.select_text(tree, "p")
+
+    # no </head>, falls back to parsing everything
+    tree = dom.parse_head("<title>Hello</title><p>World</p>")
+    assert dom.select_text(tree, "p") == "World"
+
+
+def test_form_fields():
+    tree = dom.parse_html('<form><input name="a" value="1"><input name="answer"><input type="submit"></form>')
+    assert dom.form_fields(tree.css("form")[0]) == {"a": "1", "answer": None}
+
+
+def test_select_attr():
+    tree = dom.parse_html('<a href=" /next">next</a><a class="empty" href>none</a>')
+    assert dom.select_attr(tree, "a", "href") == " /next"
+
+    # valueless attribute
+    assert dom.select_attr(tree, "a.empty", "href") == ""
+
+    with pytest.raises(KeyError):
+        dom.select_attr(tree, "a", "title")
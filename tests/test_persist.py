@@ -1,3 +1,4 @@
+import asyncio
 from urllib.parse import urlsplit
 
 import pytest
@@ -20,7 +21,97 @@ def test_build_concise_url():
 
             ("https://www.google.com/search/foo=bar?long_string={}&hello=world&long_string={}#abc".format('x' * 15, 'x' * 15),
              "/search/foo=bar?hello=world"),
+
+            ("https://www.google.com/search?q=table&empty=&flag&page=2",
+             "/search?q=table&page=2"),
+
+            # values are measured decoded, a short non-ascii keyword is kept
+            ("https://www.amazon.com/s?k=%CF%84%CF%81%CE%B1%CF%80%CE%AD%CE%B6%CE%B9+%CE%BE%CF%8D%CE%BB%CE%BF",
+             "/s?k=%CF%84%CF%81%CE%B1%CF%80%CE%AD%CE%B6%CE%B9+%CE%BE%CF%8D%CE%BB%CE%BF"),
         ]:
         url_parts = urlsplit(url)
         concise_url = ps.build_concise_url(url_parts)
         assert concise_url == expected
+
+
+def test_back_by_storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(ps, "STORAGE_PATH", str(tmp_path))
+    url = "https://www.amazon.com/s?k=table"
+    fetched = []
+
+    async def fetch(url, **kwargs):
+        fetched.append(url)
+        return ps.FetchResult(ps.FetchOutcome.SUCCESS, "<html>café</html>")
+
+    download = ps.back_by_storage(run_timestamp=1)(fetch)
+
+    result = asyncio.run(download(url))
+    assert result == ps.FetchResult(ps.FetchOutcome.SUCCESS, "<html>café</html>", from_cache=False)
+
+    result = asyncio.run(download(url))
+    assert result == ps.FetchResult(ps.FetchOutcome.SUCCESS, "<html>café</html>", from_cache=True)
+    assert fetched == [url]
+
+    result = asyncio.run(download(url, read_from_cache=False))
+    assert result.from_cache is False
+    assert fetched == [url, url]
+
+
+def test_back_by_storage_revalidates_previous_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(ps, "STORAGE_PATH", str(tmp_path))
+    url = "https://www.amazon.com/s?k=chair"
+    requests = []
+
+    async def fetch(url, extra_headers=None, **kwargs):
+        requests.append(extra_headers)
+
+        if extra_headers and extra_headers.get("If-None-Match") == '"v1"':
+            return ps.FetchResult(ps.FetchOutcome.NOT_MODIFIED)
+
+        return ps.FetchResult(ps.FetchOutcome.SUCCESS, "<html>chair</html>", validators={"ETag": '"v1"'})
+
+    result = asyncio.run(ps.back_by_storage(run_timestamp=1)(fetch)(url))
+    assert result.content == "<html>chair</html>" and result.from_cache is False
+
+    result = asyncio.run(ps.back_by_storage(run_timestamp=2)(fetch)(url, extra_headers={"Referer": "x"}))
+    assert result.content == "<html>chair</html>" and result.from_cache is True
+    assert requests == [None, {"Referer": "x", "If-None-Match": '"v1"'}]
+
+    # the page is saved for the new run, together with its validators
+    result = asyncio.run(ps.back_by_storage(run_timestamp=3)(fetch)(url))
+    assert result.from_cache is True
+    assert requests[-1] == {"If-None-Match": '"v1"'}
+
+
+def test_get_dir_index_lists_once(tmp_path, monkeypatch):
+    listed = []
+
+    def list_dir(dirpath):
+        listed.append(dirpath)
+        return {"a.zst"}
+
+    monkeypatch.setattr(ps, "_list_dir", list_dir)
+
+    async def look_up_concurrently():
+        return await asyncio.gather(*[ps._get_dir_index(tmp_path) for i in range(3)])
+
+    indexes = asyncio.run(look_up_concurrently())
+
+    assert listed == [tmp_path]
+    assert all(index is indexes[0] for index in indexes)
+
+
+def test_back_by_storage_unrequested_not_modified(tmp_path, monkeypatch):
+    monkeypatch.setattr(ps, "STORAGE_PATH", str(tmp_path))
+    url = "https://www.amazon.com/s?k=lamp"
+
+    async def fetch(url, **kwargs):
+        return ps.FetchResult(ps.FetchOutcome.NOT_MODIFIED)
+
+    # no page from a previous run to revalidate
+    result = asyncio.run(ps.back_by_storage(run_timestamp=5)(fetch)(url))
+    assert result.outcome == ps.FetchOutcome.RETRY
+
+    # a retry does not read from cache, so it sends no conditional request either
+    result = asyncio.run(ps.back_by_storage(run_timestamp=5)(fetch)(url, read_from_cache=False))
+    assert result.outcome == ps.FetchOutcome.RETRY
@@ -1,3 +1,4 @@
+import asyncio
 import os.path
 
 import pytest
@@ -21,3 +22,10 @@ def test_ocr(example_captcha):
         cp.ocr(b'x', config="-psm 6")
 
     assert cp.ocr(example_captcha, config="-psm 6") == "MJGPLP"
+
+
+def test_solve_captcha_outside_context():
+    solver = cp.CaptchaSolver(config="-psm 6")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(solver.solve_captcha(b'x'))
@@ -0,0 +1,15 @@
+from rc_crawler.utils import normalize_url
+
+
+def test_normalize_url():
+    for url, expected in [
+            ("https://www.amazon.com/dp/B01?th=1#reviews",
+             "https://www.amazon.com/dp/B01?th=1"),
+            ("HTTPS://WWW.Amazon.com/dp/B01?utm_source=x&th=1&utm_medium=y",
+             "https://www.amazon.com/dp/B01?th=1"),
+            ("http://www.aliexpress.com/item/1.html?spm=a&algo=b",
+             "http://www.aliexpress.com/item/1.html?algo=b&spm=a"),
+            ("http://www.aliexpress.com/item/1.html?",
+             "http://www.aliexpress.com/item/1.html"),
+    ]:
+        assert normalize_url(url) == expected